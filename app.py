@@ -4,8 +4,10 @@ import logging
 import os
 from werkzeug.utils import secure_filename
 import file_manager
+from file_manager import QuotaExceededError, parse_expiry
 from panel import panel_bp, init_panel
 import atexit
+import shutil
 from datetime import timedelta, datetime
 import json
 
@@ -22,12 +24,29 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)  # Sessions last 3
 UPLOAD_FOLDER = "data"
 CONFIG_FOLDER = "config"
 API_KEYS_FILE = os.path.join(CONFIG_FOLDER, "api_keys.txt")
+USAGE_FILE = os.path.join(CONFIG_FOLDER, "usage.json")
+OWNERS_FILE = os.path.join(CONFIG_FOLDER, "owners.jsonl")
+EXPIRY_FILE = os.path.join(CONFIG_FOLDER, "expirations.jsonl")
+DEBUG = True
+
+# Storage quotas in bytes, unset or 0 means unlimited
+FOLDER_QUOTA_BYTES = int(os.environ.get("FOLDER_QUOTA_BYTES", 0)) or None
+KEY_QUOTA_BYTES = int(os.environ.get("KEY_QUOTA_BYTES", 0)) or None
+UPLOAD_SIZE_SLACK = 8 * 1024  # Allowance for multipart framing in the early quota check
+
+# Expired file sweeper, deletes at most EXPIRY_SWEEP_BATCH files per batch
+EXPIRY_SWEEP_INTERVAL = max(int(os.environ.get("EXPIRY_SWEEP_INTERVAL", 60)), 1)
+EXPIRY_SWEEP_BATCH = max(int(os.environ.get("EXPIRY_SWEEP_BATCH", 100)), 1)
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(CONFIG_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-file_manager = file_manager.FileManager(UPLOAD_FOLDER)
+file_manager = file_manager.FileManager(UPLOAD_FOLDER, USAGE_FILE, FOLDER_QUOTA_BYTES, KEY_QUOTA_BYTES, EXPIRY_FILE, OWNERS_FILE)
+
+# The debug reloader imports this module in a watcher process too; only sweep in the serving one
+if not DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    file_manager.start_expiry_sweeper(EXPIRY_SWEEP_INTERVAL, EXPIRY_SWEEP_BATCH)
 
 api_keys = {}
 TEMP_KEYS_FILE = os.path.join(CONFIG_FOLDER, "temp_keys.json")
@@ -101,13 +120,40 @@ def hello_world():
 
 @app.route("/health")
 def health_check():
+    disk = shutil.disk_usage(UPLOAD_FOLDER)
+    storage_usage = file_manager.get_usage()["total"]
     return jsonify({
         "status": "healthy",
         "upload_folder": UPLOAD_FOLDER,
         "config_folder": CONFIG_FOLDER,
-        "api_keys_loaded": len(api_keys)
+        "api_keys_loaded": len(api_keys),
+        "storage": {
+            "used_bytes": storage_usage["bytes"],
+            "objects": storage_usage["objects"],
+            "disk_total_bytes": disk.total,
+            "disk_free_bytes": disk.free
+        }
     }), 200
 
+@app.route("/usage", methods=["GET"])
+def usage():
+    auth_key = request.headers.get('API-KEY')
+    if not is_valid_api_key(auth_key):
+        return {"error": "Unauthorized"}, 401
+    
+    try:
+        return file_manager.get_usage(request.args.get('folder'), auth_key)
+    except FileNotFoundError as e:
+        return {"error": str(e)}, 404
+
+@app.route("/usage/reconcile", methods=["POST"])
+def reconcile_usage():
+    auth_key = request.headers.get('API-KEY')
+    if not is_valid_api_key(auth_key):
+        return {"error": "Unauthorized"}, 401
+    
+    return file_manager.reconcile_usage()
+
 @app.route("/api-keys/create", methods=["GET", "POST"])
 def create_api_key():
     auth_key = request.headers.get('API-KEY')
@@ -209,6 +255,23 @@ def add():
         api_key = request.headers.get('API-KEY')
         if is_valid_api_key(api_key):
             try:
+                # Reject over-quota uploads from the declared request size
+                # before the body is parsed or anything is written. Werkzeug
+                # never reads past Content-Length, so it bounds the upload.
+                upload_size = request.content_length
+                quotas_enabled = FOLDER_QUOTA_BYTES is not None or KEY_QUOTA_BYTES is not None
+                if upload_size is None and quotas_enabled:
+                    return "Content-Length is required", 411
+
+                # Pass the folder as a query arg or header so its quota is
+                # checked up front. The older form field is still accepted,
+                # but its folder quota is only checked once the file is written.
+                # Content-Length includes multipart framing, so allow some slack
+                # here; save_file checks the exact size.
+                target_folder = request.args.get('folder', request.headers.get('FOLDER'))
+                early_size = max((upload_size or 0) - UPLOAD_SIZE_SLACK, 0)
+                file_manager.check_quota(early_size, folder=target_folder, api_key=api_key)
+
                 if 'file' not in request.files:
                     return "No file part in request", 400
 
@@ -216,10 +279,14 @@ def add():
                 if file.filename == '':
                     return "No selected file", 400
 
-                target_folder = request.form.get('folder', '')
+                if target_folder is None:
+                    target_folder = request.form.get('folder', '')
+                expires_at = parse_expiry(request.form.get('ttl'), request.form.get('expires_at'))
                 
-                return file_manager.save_file(file, target_folder)
+                return file_manager.save_file(file, target_folder, api_key, expires_at)
 
+            except QuotaExceededError as e:
+                return f"Error: {str(e)}", 507
             except Exception as e:
                 logging.error(f"Error adding item: {str(e)}")
                 return f"Error: {str(e)}", 400
@@ -229,4 +296,4 @@ def add():
             return "Unauthorized", 401
     return render_template("add.html", title="Add Item")
 
-app.run(debug=True, host='0.0.0.0', port=5000)
+app.run(debug=DEBUG, host='0.0.0.0', port=5000)
@@ -1,23 +1,391 @@
+import bisect
 import fernet
+import hashlib
+import itertools
+import json
+import logging
 import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from werkzeug.utils import secure_filename
 try:
     from PIL import Image
 except ImportError:
     Image = None
 
+MAX_EXPIRY_SECONDS = 365 * 24 * 60 * 60  # Same 1 year cap as temporary API keys
+TEMP_PREFIX = ".upload-"  # In-progress writes, moved into place once complete
+
+class QuotaExceededError(Exception):
+    pass
+
+def parse_expiry(ttl=None, expires_at=None):
+    """Turn a TTL in seconds or an ISO datetime into an expiry timestamp"""
+    if ttl:
+        try:
+            ttl = int(ttl)
+        except ValueError:
+            raise ValueError("Invalid ttl value")
+        if ttl <= 0:
+            raise ValueError("TTL must be a positive number of seconds")
+        if ttl > MAX_EXPIRY_SECONDS:
+            raise ValueError("TTL cannot be more than 1 year")
+        return time.time() + ttl
+    
+    if expires_at:
+        try:
+            expiry = datetime.fromisoformat(expires_at.replace('Z', '+00:00')).timestamp()
+        except (ValueError, AttributeError, OverflowError, OSError) as e:
+            raise ValueError(f"Invalid datetime format: {str(e)}")
+        if expiry <= time.time():
+            raise ValueError("Expiration date must be in the future")
+        if expiry > time.time() + MAX_EXPIRY_SECONDS:
+            raise ValueError("Expiration date cannot be more than 1 year in the future")
+        return expiry
+    
+    return None
+
+def format_expiry(expires_at):
+    return datetime.fromtimestamp(expires_at, timezone.utc).isoformat()
+
 class FileManager:
-    def __init__(self, upload_folder):
+    def __init__(self, upload_folder, usage_file=None, folder_quota=None, key_quota=None, expiry_file=None, owners_file=None):
         self.upload_folder = upload_folder
+        self.usage_file = usage_file
+        self.owners_file = owners_file
+        self.expiry_file = expiry_file
+        self.folder_quota = folder_quota  # Max bytes per folder, None means unlimited
+        self.key_quota = key_quota  # Max bytes per uploading API key, None means unlimited
+        self._usage_lock = threading.RLock()
+        self._transaction_depth = 0
+        self._usage_suspect = False  # A write failed midway, keep the marker until reconciled
         self.files = {}
 
         self.files = self.get_all_files()
+        self.owners = self._load_owners()  # rel_path -> key id of the uploading API key
+        self.usage = self._load_usage()
+        self.expiry_index = self._load_expirations()  # rel_path -> expires_at
+        self.expirations = sorted([expires_at, rel_path] for rel_path, expires_at in self.expiry_index.items())
+        self._sweep_failures = {}  # rel_path -> failed delete attempts
         print(f"Initialized FileManager with files: {self.files}")
     
+    def _load_usage(self):
+        # Counters are kept incrementally; they are only rebuilt with a full
+        # walk when there is no persisted state or a write was interrupted
+        if self.usage_file and not os.path.exists(self._pending_file()):
+            try:
+                with open(self.usage_file, "r") as f:
+                    usage = json.load(f)
+                for section in ('folders', 'keys'):
+                    usage.setdefault(section, {})
+                if 'owners' in usage:
+                    # Older usage files held ownership and plaintext keys inline
+                    for rel_path, api_key in usage.pop('owners').items():
+                        self._set_owner(rel_path, self._key_id(api_key))
+                    usage['keys'] = {self._key_id(k): v for k, v in usage['keys'].items()}
+                    self.usage = usage
+                    self._save_usage()
+                return usage
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+        
+        self.reconcile_usage()
+        return self.usage
+    
+    def reconcile_usage(self):
+        """Rebuild the counters from the files on disk and the ownership log"""
+        with self._usage_lock:
+            usage = {'folders': {'': {'bytes': 0, 'objects': 0}}, 'keys': {}}
+            seen = set()
+            for root, dirs, files in os.walk(self.upload_folder):
+                entry = usage['folders'].setdefault(self._rel_path(root), {'bytes': 0, 'objects': 0})
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        if name.startswith(TEMP_PREFIX):
+                            # Left behind by an interrupted write
+                            if os.path.getmtime(path) < time.time() - 3600:
+                                os.remove(path)
+                            continue
+                        size = os.path.getsize(path)
+                    except OSError:
+                        continue
+                    
+                    rel_path = self._rel_path(path)
+                    seen.add(rel_path)
+                    entry['bytes'] += size
+                    entry['objects'] += 1
+                    
+                    key_id = self.owners.get(rel_path)
+                    if key_id:
+                        key_entry = usage['keys'].setdefault(key_id, {'bytes': 0, 'objects': 0})
+                        key_entry['bytes'] += size
+                        key_entry['objects'] += 1
+            
+            for rel_path in [rel_path for rel_path in self.owners if rel_path not in seen]:
+                self._set_owner(rel_path, None)
+            
+            self.usage = usage
+            self._save_usage()
+            self._usage_suspect = False
+            self._set_pending(False)
+            return self.get_usage()
+    
+    def _save_usage(self):
+        if not self.usage_file:
+            return
+        tmp_file = self.usage_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.usage, f)
+        os.replace(tmp_file, self.usage_file)
+    
+    def _pending_file(self):
+        return self.usage_file + ".pending"
+    
+    def _set_pending(self, pending):
+        if not self.usage_file:
+            return
+        if pending:
+            open(self._pending_file(), "w").close()
+        elif os.path.exists(self._pending_file()):
+            os.remove(self._pending_file())
+    
+    @contextmanager
+    def _usage_transaction(self):
+        # The marker stays behind if the block fails or the process dies,
+        # so the counters are reconciled with the disk on the next start
+        with self._usage_lock:
+            self._transaction_depth += 1
+            if self._transaction_depth == 1:
+                self._set_pending(True)
+            try:
+                yield
+            except Exception:
+                self._usage_suspect = True
+                raise
+            finally:
+                self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self._save_usage()
+                if not self._usage_suspect:
+                    self._set_pending(False)
+    
+    def _load_owners(self):
+        # Ownership is an append-only log of {"path", "key"} records so each
+        # upload or delete writes one line instead of rewriting the whole map
+        owners = {}
+        self._owner_log_records = 0
+        if not self.owners_file:
+            return owners
+        
+        try:
+            with open(self.owners_file, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._owner_log_records += 1
+                    if record.get('key'):
+                        owners[record['path']] = record['key']
+                    else:
+                        owners.pop(record['path'], None)
+        except FileNotFoundError:
+            return owners
+        
+        if self._owner_log_records > 2 * len(owners) + 1000:
+            self._compact_log(self.owners_file, [{'path': p, 'key': k} for p, k in owners.items()])
+            self._owner_log_records = len(owners)
+        return owners
+    
+    def _compact_log(self, log_file, records):
+        # Rewrite a log once it is mostly superseded records
+        tmp_file = log_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmp_file, log_file)
+    
+    def _set_owner(self, rel_path, key_id):
+        if key_id:
+            self.owners[rel_path] = key_id
+        elif self.owners.pop(rel_path, None) is None:
+            return
+        
+        if self.owners_file:
+            with open(self.owners_file, "a") as f:
+                f.write(json.dumps({'path': rel_path, 'key': key_id}) + "\n")
+            self._owner_log_records += 1
+            if self._owner_log_records > 2 * len(self.owners) + 1000:
+                self._compact_log(self.owners_file, [{'path': p, 'key': k} for p, k in self.owners.items()])
+                self._owner_log_records = len(self.owners)
+    
+    def _key_id(self, api_key):
+        # Usage is tracked per key without storing the secret itself
+        if not api_key:
+            return None
+        return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    
+    def _load_expirations(self):
+        # Same append-only layout as the owners log, with {"path", "expires_at"} records
+        index = {}
+        self._expiry_log_records = 0
+        if not self.expiry_file:
+            return index
+        
+        try:
+            with open(self.expiry_file, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._expiry_log_records += 1
+                    if record.get('expires_at') is not None:
+                        index[record['path']] = record['expires_at']
+                    else:
+                        index.pop(record['path'], None)
+        except FileNotFoundError:
+            return index
+        
+        if self._expiry_log_records > 2 * len(index) + 1000:
+            self._compact_log(self.expiry_file, [{'path': p, 'expires_at': t} for p, t in index.items()])
+            self._expiry_log_records = len(index)
+        return index
+    
+    def _log_expirations(self, records):
+        if not self.expiry_file or not records:
+            return
+        with open(self.expiry_file, "a") as f:
+            for rel_path, expires_at in records:
+                f.write(json.dumps({'path': rel_path, 'expires_at': expires_at}) + "\n")
+        self._expiry_log_records += len(records)
+        if self._expiry_log_records > 2 * len(self.expiry_index) + 1000:
+            self._compact_log(self.expiry_file, [{'path': p, 'expires_at': t} for p, t in self.expiry_index.items()])
+            self._expiry_log_records = len(self.expiry_index)
+    
+    def _drop_expiry(self, rel_path):
+        expires_at = self.expiry_index.pop(rel_path, None)
+        if expires_at is None:
+            return
+        index = bisect.bisect_left(self.expirations, [expires_at, rel_path])
+        del self.expirations[index]
+        self._log_expirations([(rel_path, None)])
+    
+    def set_expiry(self, rel_path, expires_at):
+        with self._usage_lock:
+            self._drop_expiry(rel_path)
+            if expires_at is not None:
+                self.expiry_index[rel_path] = expires_at
+                bisect.insort(self.expirations, [expires_at, rel_path])
+                self._log_expirations([(rel_path, expires_at)])
+    
+    def sweep_expired(self, limit=100, retry_delay=300):
+        """Delete up to limit objects whose expiry has passed, returns how many were due"""
+        now = time.time()
+        with self._usage_lock:
+            due = [tuple(entry) for entry in itertools.takewhile(lambda entry: entry[0] <= now, self.expirations[:limit])]
+        
+        # Each file is re-checked and deleted under the lock, which is only
+        # released between files so uploads and deletes aren't held up by the batch
+        for expires_at, rel_path in due:
+            with self._usage_lock:
+                # Skip entries that changed since the batch was read, e.g. the
+                # file was deleted and uploaded again under the same name
+                if self.expiry_index.get(rel_path) != expires_at:
+                    continue
+                self._drop_expiry(rel_path)
+                
+                try:
+                    self.delete_file(rel_path)
+                    self._sweep_failures.pop(rel_path, None)
+                except FileNotFoundError:
+                    self._sweep_failures.pop(rel_path, None)
+                except Exception as e:
+                    logging.error(f"Error deleting expired file {rel_path}: {str(e)}")
+                    # Put it back with an exponential backoff so it still expires eventually
+                    failures = self._sweep_failures.get(rel_path, 0) + 1
+                    self._sweep_failures[rel_path] = failures
+                    self.set_expiry(rel_path, time.time() + retry_delay * 2 ** min(failures - 1, 6))
+        return len(due)
+    
+    def start_expiry_sweeper(self, interval=60, batch_size=100, batch_pause=1.0):
+        if batch_size < 1:
+            raise ValueError("Sweep batch size must be at least 1")
+        
+        def sweep():
+            while True:
+                # Keep sweeping in rate-limited batches until nothing is due
+                while self.sweep_expired(batch_size) == batch_size:
+                    time.sleep(batch_pause)
+                time.sleep(interval)
+        
+        thread = threading.Thread(target=sweep, name="expiry-sweeper", daemon=True)
+        thread.start()
+        return thread
+    
+    def _rel_path(self, path):
+        rel_path = os.path.relpath(path, self.upload_folder).replace(os.sep, '/')
+        return '' if rel_path == '.' else rel_path
+    
+    def _record_usage(self, rel_path, size_delta, object_delta, key_id=None):
+        folder = os.path.dirname(rel_path)
+        entry = self.usage['folders'].setdefault(folder, {'bytes': 0, 'objects': 0})
+        entry['bytes'] += size_delta
+        entry['objects'] += object_delta
+        
+        if key_id:
+            entry = self.usage['keys'].setdefault(key_id, {'bytes': 0, 'objects': 0})
+            entry['bytes'] += size_delta
+            entry['objects'] += object_delta
+    
+    def get_usage(self, folder=None, api_key=None):
+        with self._usage_lock:
+            folders = self.usage['folders']
+            total = {
+                'bytes': sum(entry['bytes'] for entry in folders.values()),
+                'objects': sum(entry['objects'] for entry in folders.values()),
+            }
+            if folder is not None:
+                folder = secure_filename(folder)
+                if folder not in folders:
+                    raise FileNotFoundError(f"Folder {folder} not found")
+                folders = {folder: folders[folder]}
+            
+            usage = {
+                'total': total,
+                'folders': {name: dict(entry) for name, entry in folders.items()},
+                'quotas': {'folder_bytes': self.folder_quota, 'key_bytes': self.key_quota},
+            }
+            if api_key is not None:
+                usage['key'] = dict(self.usage['keys'].get(self._key_id(api_key), {'bytes': 0, 'objects': 0}))
+            return usage
+    
+    def check_quota(self, size, folder=None, api_key=None):
+        with self._usage_lock:
+            self._check_quota(size, folder, self._key_id(api_key))
+    
+    def _check_quota(self, size, folder=None, key_id=None):
+        if folder is not None and self.folder_quota is not None:
+            folder = secure_filename(folder) if folder else ''
+            used = self.usage['folders'].get(folder, {}).get('bytes', 0)
+            if used + size > self.folder_quota:
+                raise QuotaExceededError(f"Folder quota exceeded ({used + size} of {self.folder_quota} bytes)")
+        
+        if key_id is not None and self.key_quota is not None:
+            used = self.usage['keys'].get(key_id, {}).get('bytes', 0)
+            if used + size > self.key_quota:
+                raise QuotaExceededError(f"API key quota exceeded ({used + size} of {self.key_quota} bytes)")
+    
     def get_all_files(self):
         try:
             files = []
             for item in os.listdir(self.upload_folder):
+                if item.startswith(TEMP_PREFIX):
+                    continue
                 item_path = os.path.join(self.upload_folder, item)
                 extension = os.path.splitext(item)[1].lower() if os.path.isfile(item_path) else None
                 files.append({
@@ -163,43 +531,104 @@ class FileManager:
         except UnicodeDecodeError:
             return "[Binary file - cannot display as text]"
     
-    def save_file_content(self, filename, content):
+    def _save_temp(self, directory, save):
+        # Writes happen without holding the lock, only the move into place is serialized
+        tmp_path = os.path.join(directory, f"{TEMP_PREFIX}{uuid.uuid4().hex}.tmp")
+        try:
+            save(tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return tmp_path
+    
+    def _commit_file(self, tmp_path, file_path, key_id=None, expires_at=None, unique=False):
+        """Move a fully written temp file into place, enforcing quotas against its real size"""
+        try:
+            with self._usage_lock:
+                if unique and os.path.exists(file_path):
+                    # Add number to filename
+                    name, ext = os.path.splitext(file_path)
+                    counter = 1
+                    while os.path.exists(file_path):
+                        file_path = f"{name}_{counter}{ext}"
+                        counter += 1
+                
+                rel_path = self._rel_path(file_path)
+                existed = os.path.isfile(file_path)
+                if existed:
+                    key_id = self.owners.get(rel_path)
+                size_delta = os.path.getsize(tmp_path) - (os.path.getsize(file_path) if existed else 0)
+                if size_delta > 0:
+                    self._check_quota(size_delta, os.path.dirname(rel_path), key_id)
+                
+                with self._usage_transaction():
+                    os.replace(tmp_path, file_path)
+                    if not existed:
+                        self._set_owner(rel_path, key_id)
+                    self._record_usage(rel_path, size_delta, 0 if existed else 1, key_id)
+                    if expires_at is not None:
+                        self.set_expiry(rel_path, expires_at)
+                return rel_path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def save_file_content(self, filename, content, api_key=None):
         file_path = os.path.join(self.upload_folder, filename)
         
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        
+        tmp_path = self._save_temp(os.path.dirname(file_path), write)
+        self._commit_file(tmp_path, file_path, self._key_id(api_key))
     
-    def upload_file(self, file):
+    def upload_file(self, file, api_key=None, expires_at=None):
         filename = secure_filename(file.filename)
         if not filename:
             raise ValueError("Invalid filename")
         
-        file_path = os.path.join(self.upload_folder, filename)
-        
-        # Check if file already exists
-        if os.path.exists(file_path):
-            # Add number to filename
-            name, ext = os.path.splitext(filename)
-            counter = 1
-            while os.path.exists(file_path):
-                filename = f"{name}_{counter}{ext}"
-                file_path = os.path.join(self.upload_folder, filename)
-                counter += 1
-        
-        file.save(file_path)
-        return filename
+        tmp_path = self._save_temp(self.upload_folder, file.save)
+        return self._commit_file(tmp_path, os.path.join(self.upload_folder, filename),
+                                 self._key_id(api_key), expires_at, unique=True)
     
     def delete_file(self, filename):
         file_path = os.path.join(self.upload_folder, filename)
         
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"File or folder {filename} not found")
-        
-        if os.path.isdir(file_path):
-            import shutil
-            shutil.rmtree(file_path)
-        else:
-            os.remove(file_path)
+        with self._usage_transaction():
+            if not os.path.exists(file_path):
+                raise FileNotFoundError(f"File or folder {filename} not found")
+            
+            # Collect what is about to be removed so the counters can be
+            # decremented without rescanning the rest of the store
+            removed = []
+            is_dir = os.path.isdir(file_path)
+            if is_dir:
+                for root, dirs, files in os.walk(file_path):
+                    for name in files:
+                        path = os.path.join(root, name)
+                        removed.append((self._rel_path(path), os.path.getsize(path)))
+                
+                import shutil
+                shutil.rmtree(file_path)
+            else:
+                removed.append((self._rel_path(file_path), os.path.getsize(file_path)))
+                os.remove(file_path)
+            
+            for rel_path, size in removed:
+                owner = self.owners.get(rel_path)
+                self._set_owner(rel_path, None)
+                self._record_usage(rel_path, -size, -1, owner)
+            
+            for rel_path, size in removed:
+                self._drop_expiry(rel_path)
+            
+            if is_dir:
+                rel_dir = self._rel_path(file_path)
+                for folder in list(self.usage['folders']):
+                    if folder == rel_dir or folder.startswith(rel_dir + '/'):
+                        del self.usage['folders'][folder]
     
     def create_folder(self, folder_name):
         folder_name = secure_filename(folder_name)
@@ -211,9 +640,11 @@ class FileManager:
         if os.path.exists(folder_path):
             raise FileExistsError(f"Folder {folder_name} already exists")
         
-        os.makedirs(folder_path)
+        with self._usage_transaction():
+            os.makedirs(folder_path)
+            self.usage['folders'].setdefault(folder_name, {'bytes': 0, 'objects': 0})
 
-    def save_file(self, file, target_folder=''):
+    def save_file(self, file, target_folder='', api_key=None, expires_at=None):
         safe_filename = secure_filename(fernet.Fernet.generate_key().decode() + "_" + file.filename)
         
         # Sanitize and validate target folder
@@ -232,8 +663,15 @@ class FileManager:
         else:
             file_path = os.path.join(self.upload_folder, safe_filename)
         
-        file.save(file_path)
-        return {"message": "Item added successfully!", "filename": safe_filename, "folder": target_folder}, 200
+        response = {"message": "Item added successfully!", "filename": safe_filename, "folder": target_folder}
+        if expires_at is not None:
+            response["expires_at"] = format_expiry(expires_at)
+        
+        # The quota is checked against the real size in the same locked step
+        # as the counter update, so concurrent uploads can't overshoot it
+        tmp_path = self._save_temp(os.path.dirname(file_path), file.save)
+        self._commit_file(tmp_path, file_path, self._key_id(api_key), expires_at)
+        return response, 200
 
     def get_file_path(self, filename):
         safe_filename = secure_filename(filename)
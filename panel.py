@@ -2,6 +2,7 @@ from flask import Flask, render_template, request, send_file, jsonify, redirect,
 from fernet import Fernet
 import logging
 import os
+from file_manager import QuotaExceededError, parse_expiry, format_expiry
 
 panel_bp = Blueprint('panel', __name__, template_folder='templates')
 file_manager_instance = None
@@ -64,8 +65,10 @@ def save_file(filename):
     
     try:
         content = request.json.get('content')
-        file_manager_instance.save_file_content(filename, content)
+        file_manager_instance.save_file_content(filename, content, session['api_key'])
         return jsonify({"success": True, "message": "File saved successfully"})
+    except QuotaExceededError as e:
+        return jsonify({"error": str(e)}), 507
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -82,8 +85,18 @@ def upload_file():
         if file.filename == '':
             return jsonify({"error": "No file selected"}), 400
         
-        filename = file_manager_instance.upload_file(file)
-        return jsonify({"success": True, "message": "File uploaded successfully", "filename": filename})
+        try:
+            expires_at = parse_expiry(request.form.get('ttl'), request.form.get('expires_at'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        filename = file_manager_instance.upload_file(file, session['api_key'], expires_at)
+        response = {"success": True, "message": "File uploaded successfully", "filename": filename}
+        if expires_at is not None:
+            response["expires_at"] = format_expiry(expires_at)
+        return jsonify(response)
+    except QuotaExceededError as e:
+        return jsonify({"error": str(e)}), 507
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 